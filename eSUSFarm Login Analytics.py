@@ -22,21 +22,50 @@
 # In[ ]:
 
 
-#!pip install pandas plotly sqlalchemy dash dash-bootstrap-components scikit-learn pyodbc
+#!pip install pandas pyarrow plotly datashader sqlalchemy dash dash-bootstrap-components scikit-learn jenkspy orjson kaleido pyodbc
 
 
 # In[1]:
 
 
 #Imports:
+import os
+import base64
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 import sqlalchemy
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.preprocessing import StandardScaler
+from IPython.display import display
+
+# Pick the renderer once and serialize figures with orjson instead of the stdlib json encoder
+pio.renderers.default = "notebook_connected"
+pio.json.config.default_engine = "orjson"
+
+# Set ESUSFARM_STATIC_FIGURES=1 before a run that will be exported: show_figure then also stores a
+# kaleido PNG next to the interactive chart, and the exporters prefer image/png, so the exported
+# PDF/HTML need no Plotly.js for it. Interactive runs skip kaleido's headless browser start-up.
+STATIC_FIGURES = os.environ.get("ESUSFARM_STATIC_FIGURES") == "1"
+
+def show_figure(fig):
+    if not STATIC_FIGURES:
+        fig.show(validate=False)
+        return
+    bundle = {"text/html": pio.to_html(fig, include_plotlyjs="cdn", full_html=False, validate=False)}
+    try:
+        png = fig.to_image(format='png', width=900, height=500)
+        bundle["image/png"] = base64.b64encode(png).decode("ascii")
+    except (ValueError, RuntimeError) as e:  # kaleido (or its browser) missing: interactive chart only
+        print(f"⚠️ No static copy of the figure for export: {e}")
+    display(bundle, raw=True)
 
 
 # In[2]:
@@ -53,7 +82,9 @@ params = urllib.parse.quote_plus(
     f"DRIVER={{ODBC Driver 17 for SQL Server}};"
     f"SERVER={server};DATABASE={database};UID={username};PWD={password}"
 )
-engine = sqlalchemy.create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
+# Pool a few connections so the independent queries below can run side by side
+engine = sqlalchemy.create_engine(f"mssql+pyodbc:///?odbc_connect={params}",
+                                  pool_size=4, pool_pre_ping=True, connect_args={"timeout": 30})
 
 
 # In[3]:
@@ -61,69 +92,198 @@ engine = sqlalchemy.create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
 
 #Fetch and prepate data:
 
-def fetch_and_process_data():
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def week_key(dates):
+    # Monday-start week number as int32 (same weeks as to_period("W"), no Period objects).
+    # The epoch is a Thursday, so shift by 3 days to land week boundaries on Mondays.
+    ns = dates.to_numpy("datetime64[ns]").view("i8")
+    return ((ns + 3 * 86_400_000_000_000) // (7 * 86_400_000_000_000)).astype("int32")
+
+
+# Bump the file name whenever the session query's column list changes
+SMS_CACHE = os.path.join("cache", "sms_v2.parquet")
+# Cached rows this close to the newest SubmitDate are re-fetched on every run, so SMS that
+# are delivered late or logged late (with an already-seen SubmitDate) still make it in
+CACHE_REFRESH_WINDOW = pd.Timedelta(days=7)
+# Older rows can still change on the server (farmer Gender/Province, farmers added later,
+# very late deliveries, deletions), so the whole cache is rebuilt once it is this old
+CACHE_MAX_AGE = pd.Timedelta(days=7)
+
+
+def read_sms_cache(cache_path):
+    # Cached rows plus the time of the full rebuild they started from (kept in the
+    # Parquet schema metadata); (None, None) when there is nothing usable to resume from
+    if not os.path.exists(cache_path):
+        return None, None
+    table = pq.read_table(cache_path)
+    built_at = (table.schema.metadata or {}).get(b"full_refresh_at")
+    if built_at is None or table.num_rows == 0:
+        return None, None
+    return table.to_pandas(), pd.Timestamp(built_at.decode())
+
+
+def fetch_and_process_data(cache_path=SMS_CACHE):
+    # Rows already in the local Parquet cache are not downloaded again: only the trailing
+    # refresh window is fetched, and it replaces the cached rows from that window.
+    cached, built_at = read_sms_cache(cache_path)
+    if cached is not None and pd.Timestamp.now() - built_at > CACHE_MAX_AGE:
+        cached = None
+    if cached is None:
+        built_at = pd.Timestamp.now()
+
     query = """
     SELECT
         a.[FarmerId], a.[MobileNumber], a.[Name], a.[Gender], a.[Province],
         b.SubmitDate, b.DeliveredDate,
-        CAST(b.SubmitDate AS DATE) AS session_date,
-        d.CropName
+        DATEPART(hour, b.SubmitDate) AS login_hour,
+        DATENAME(weekday, b.DeliveredDate) AS login_day
     FROM [dbo].[Farmers] a
     INNER JOIN [dbo].[SMSNotificationLogs] b
-        ON CAST(a.[MobileNumber] AS VARCHAR) = CAST(b.[MobileNumber] AS VARCHAR)
-    LEFT JOIN [dbo].[FarmerCrops] c
-        ON c.[FarmerId] = a.FarmerId
-    LEFT JOIN [dbo].[Crops] d
+        ON a.[MobileNumber] = b.[MobileNumber]
+    WHERE b.SubmitDate IS NOT NULL
+      AND b.DeliveredDate IS NOT NULL
+      AND b.DeliveredDate >= b.SubmitDate
+    """
+    sql_params = None
+    if cached is not None:
+        cutoff = cached["SubmitDate"].max() - CACHE_REFRESH_WINDOW
+        query += "  AND b.SubmitDate >= ?\n"
+        sql_params = (cutoff.to_pydatetime(),)
+
+    # Stream the result in chunks and keep the text columns Arrow-backed instead of
+    # materialising every value as a Python str object.
+    column_dtypes = {c: "string[pyarrow]" for c in ["MobileNumber", "Name", "Gender", "Province", "login_day"]}
+    column_dtypes["login_hour"] = "int8"
+    chunks = pd.read_sql(query, engine, params=sql_params, dtype=column_dtypes, chunksize=200_000)
+    df = pd.concat(chunks, ignore_index=True)
+    # pyodbc already returns datetime values, so this is normally a no-op; cache=True
+    # dedupes repeated timestamps if the driver ever hands back strings
+    for c in ["SubmitDate", "DeliveredDate"]:
+        df[c] = pd.to_datetime(df[c], errors="coerce", cache=True)
+
+    changed = True
+    if cached is not None:
+        kept = cached[cached["SubmitDate"] < cutoff]
+        changed = len(kept) + len(df) != len(cached)
+        print(f"ℹ️ {len(kept):,} SMS rows from the local cache (full refresh {built_at:%Y-%m-%d %H:%M}), "
+              f"{len(df):,} re-fetched from {cutoff:%Y-%m-%d} onwards")
+        df = pd.concat([kept, df], ignore_index=True)
+    else:
+        print(f"ℹ️ {len(df):,} SMS rows fetched from the server (full refresh)")
+    # Never persist an empty result: there is no high-water mark to resume from
+    if changed and len(df) > 0:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               b"full_refresh_at": built_at.isoformat().encode()})
+        pq.write_table(table, cache_path, compression="zstd")
+
+    # login_hour and login_day come from the server; the rest is derived from the raw
+    # int64 nanosecond values (one subtraction and one multiply for the duration)
+    submit_ns = df["SubmitDate"].to_numpy("datetime64[ns]").view("i8")
+    delivered_ns = df["DeliveredDate"].to_numpy("datetime64[ns]").view("i8")
+    df["session_date"] = (submit_ns - submit_ns % 86_400_000_000_000).view("datetime64[ns]")
+    df["duration_mins"] = (delivered_ns - submit_ns) * (1.0 / 60e9)
+
+    # Low-cardinality labels and group keys: category codes instead of one value per row
+    df["login_day"] = pd.Categorical(df["login_day"], categories=WEEKDAYS, ordered=True)
+    for c in ["FarmerId", "Gender", "Province"]:
+        df[c] = df[c].astype("category")
+
+    # Keep each farmer's sessions contiguous so the per-farmer
+    # aggregations and lookups below walk memory sequentially
+    return df.sort_values("FarmerId", kind="stable", ignore_index=True)
+
+
+def fetch_farmer_crops():
+    # Kept out of the session query: joining crops there repeats every SMS row once
+    # per crop the farmer grows, which inflates login counts and session averages.
+    query = """
+    SELECT c.[FarmerId], d.CropName
+    FROM [dbo].[FarmerCrops] c
+    INNER JOIN [dbo].[Crops] d
         ON d.CropId = c.CropId
-    WHERE TRY_CAST(b.SubmitDate AS DATETIME) IS NOT NULL
-      AND TRY_CAST(b.DeliveredDate AS DATETIME) IS NOT NULL
     """
-    df = pd.read_sql(query, engine, parse_dates=["SubmitDate", "DeliveredDate"])
-    df["login_hour"] = df["SubmitDate"].dt.hour
-    df["login_day"] = df["DeliveredDate"].dt.day_name()
-    df["duration_mins"] = (df["DeliveredDate"] - df["SubmitDate"]).dt.total_seconds() / 60.0
-    return df
+    crops = pd.read_sql(query, engine)
+    crops["CropName"] = crops["CropName"].astype("category")
+    return crops
 
 
 
 # In[4]:
 
 
+def aggregate_engagement(farmer_ids, durations, weeks):
+    # Factorize FarmerId once into dense int codes; counts and duration sums are then
+    # plain bincounts, and distinct weeks come from unique (code, week) int64 pairs.
+    codes, uniq = pd.factorize(farmer_ids, sort=False)
+    n_farmers = len(uniq)
+    counts = np.bincount(codes, minlength=n_farmers)
+    sums = np.bincount(codes, weights=durations, minlength=n_farmers)
+
+    pairs = np.unique((codes.astype(np.int64) << 32) | (weeks - weeks.min()).astype(np.int64))
+    active_weeks = np.bincount(pairs >> 32, minlength=n_farmers)
+
+    return pd.DataFrame({
+        "LoginCount": counts,
+        "AvgSessionMins": sums / counts,
+        "ActiveWeeks": active_weeks
+    }, index=pd.Index(uniq, name="FarmerId"))
+
+
+def standardize(values):
+    # Column-wise z-score, same result as StandardScaler().fit_transform (constant columns map to 0)
+    arr = np.array(values, dtype=np.float64)
+    arr -= arr.mean(axis=0)
+    std = arr.std(axis=0)
+    std[std == 0] = 1.0
+    arr /= std
+    return arr
+
+
+def lookup_by_farmer(df, per_farmer):
+    # Broadcast a per-farmer Series onto the rows of df through the FarmerId category
+    # codes; unlike Series.map on a categorical, this keeps the values' dtype
+    values = per_farmer.reindex(df["FarmerId"].cat.categories).to_numpy()
+    return values[df["FarmerId"].cat.codes.to_numpy()]
+
+
 def compute_engagement_score(df):
-    # Create ActiveWeek from SubmitDate
-    df["ActiveWeek"] = df["SubmitDate"].dt.to_period("W").astype(str)
-    
-    engagement_df = df.groupby("FarmerId").agg({
-        "duration_mins": "mean",
-        "FarmerId": "count",  # Login count
-        "ActiveWeek": pd.Series.nunique
-    }).rename(columns={
-        "FarmerId": "LoginCount",
-        "duration_mins": "AvgSessionMins",
-        "ActiveWeek": "ActiveWeeks"
-    })
-
-    # Normalize each component
-    scaler = StandardScaler()
+    # Aggregated from the same session rows every later cell uses, so the score
+    # always matches ActiveWeeks, churn and the charts built from df
+    engagement_df = aggregate_engagement(
+        df["FarmerId"].to_numpy(), df["duration_mins"].to_numpy(), week_key(df["SubmitDate"])
+    )[["AvgSessionMins", "LoginCount", "ActiveWeeks"]]
+
+    # Normalize each component (z-scores need no more than float32 precision)
+    scaled = standardize(engagement_df).astype(np.float32)
     engagement_df_scaled = pd.DataFrame(
-        scaler.fit_transform(engagement_df),
+        scaled,
         columns=engagement_df.columns,
         index=engagement_df.index
     )
 
     # Composite Score: Simple average of the 3 normalized values
-    engagement_df_scaled["EngagementScore"] = engagement_df_scaled.mean(axis=1)
+    engagement_df_scaled["EngagementScore"] = scaled.mean(axis=1)
 
-    # Merge engagement back to original df
-    merged_df = df.merge(engagement_df_scaled[["EngagementScore"]], left_on="FarmerId", right_index=True, how="left")
+    # Attach the score to each session row with a lookup on FarmerId (in place, no merge copy)
+    df["EngagementScore"] = lookup_by_farmer(df, engagement_df_scaled["EngagementScore"])
     
-    return merged_df, engagement_df_scaled.reset_index()
+    return df, engagement_df_scaled.reset_index()
 
 
 # In[5]:
 
 
-df_raw = fetch_and_process_data()
+# The two queries are independent; pyodbc releases the GIL while waiting on the
+# server, so their round trips overlap
+with ThreadPoolExecutor(max_workers=2) as ex:
+    rows_f = ex.submit(fetch_and_process_data)
+    crops_f = ex.submit(fetch_farmer_crops)
+    df_raw, farmer_crops = rows_f.result(), crops_f.result()
+
 df, engagement_summary = compute_engagement_score(df_raw)
 
 df.head()
@@ -160,7 +320,6 @@ df.head()
 
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import StandardScaler
 
 # Simulating a mock-up data processing flow based on your provided code
 # This is assuming 'df_raw' already contains the raw data, as in the given context
@@ -183,12 +342,12 @@ df_mock = pd.DataFrame({
 })
 
 # Normalize engagement components
-scaler = StandardScaler()
 df_scaled = df_mock.copy()
-df_scaled[["LoginCount", "AvgSessionMins", "ActiveWeeks"]] = scaler.fit_transform(df_mock[["LoginCount", "AvgSessionMins", "ActiveWeeks"]])
+scaled = standardize(df_mock[["LoginCount", "AvgSessionMins", "ActiveWeeks"]]).astype(np.float32)
+df_scaled[["LoginCount", "AvgSessionMins", "ActiveWeeks"]] = scaled
 
 # Create the EngagementScore as the average of the normalized components
-df_scaled["EngagementScore"] = df_scaled[["LoginCount", "AvgSessionMins", "ActiveWeeks"]].mean(axis=1)
+df_scaled["EngagementScore"] = scaled.mean(axis=1)
 
 # Sorting the engagement data
 sorted_engagement = df_scaled.sort_values(by="EngagementScore", ascending=False)
@@ -279,9 +438,15 @@ middle_10 = sorted_engagement.iloc[len(sorted_engagement)//2 - 5 : len(sorted_en
 # In[7]:
 
 
+#Plot aggregates: scan df once here so each chart below only gets a few rows
+session_trend = df.groupby("session_date")["duration_mins"].mean().reset_index()
+hour_counts = df["login_hour"].value_counts().reindex(range(24), fill_value=0).rename_axis("login_hour").reset_index(name="count")
+day_counts = df["login_day"].value_counts(sort=False).rename_axis("login_day").reset_index(name="count")
+freq = df.groupby(['Province', 'Gender'], sort=False, observed=True).size().reset_index(name='Login Count')
+scatter_sample = df.sample(min(50_000, len(df)), random_state=42)
+
 #Basic viusalisation:
-px.line(df.groupby("session_date")["duration_mins"].mean().reset_index(),
-        x="session_date", y="duration_mins", title="Avg Session Duration Over Time")
+px.line(session_trend, x="session_date", y="duration_mins", title="Avg Session Duration Over Time")
 
 
 # ### Average Session Duration Over Time
@@ -312,7 +477,7 @@ px.line(df.groupby("session_date")["duration_mins"].mean().reset_index(),
 # In[8]:
 
 
-px.histogram(df, x="login_hour", nbins=24, title="Login Hour Frequency")
+px.bar(hour_counts, x="login_hour", y="count", title="Login Hour Frequency")
 
 
 # ### 🕒 Interpretation: Login Hour Frequency
@@ -349,8 +514,7 @@ px.histogram(df, x="login_hour", nbins=24, title="Login Hour Frequency")
 # In[9]:
 
 
-px.histogram(df, x="login_day", title="Logins by Day",
-             category_orders={"login_day": ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]})
+px.bar(day_counts, x="login_day", y="count", title="Logins by Day", category_orders={"login_day": WEEKDAYS})
 
 
 # ### 📅 Interpretation: Logins by Day of the Week
@@ -391,7 +555,6 @@ px.histogram(df, x="login_day", title="Logins by Day",
 
 
 #Login Frequency by Province and Gender
-freq = df.groupby(['Province', 'Gender']).size().reset_index(name='Login Count')
 px.bar(freq, x="Province", y="Login Count", color="Gender", barmode="group",
        title="Login Frequency by Province and Gender")
 
@@ -426,7 +589,8 @@ px.bar(freq, x="Province", y="Login Count", color="Gender", barmode="group",
 
 
 #Session Duration by Crop
-px.box(df, x="CropName", y="duration_mins", title="Session Duration by Crop")
+crop_sessions = df[["FarmerId", "duration_mins"]].merge(farmer_crops, on="FarmerId", how="inner")
+px.box(crop_sessions, x="CropName", y="duration_mins", title="Session Duration by Crop")
 
 
 # ### Session Duration by Crop
@@ -457,7 +621,7 @@ px.box(df, x="CropName", y="duration_mins", title="Session Duration by Crop")
 
 
 #Login Hour vs. Session Duration
-px.scatter(df, x="login_hour", y="duration_mins", color="Gender",
+px.scatter(scatter_sample, x="login_hour", y="duration_mins", color="Gender",
            title="Login Hour vs. Session Duration")
 
 
@@ -495,9 +659,10 @@ px.scatter(df, x="login_hour", y="duration_mins", color="Gender",
 #KMeans Clustering
 clustering_df = df[["login_hour", "duration_mins"]].dropna()
 scaler = StandardScaler()
-scaled = scaler.fit_transform(clustering_df)
+scaled = scaler.fit_transform(clustering_df).astype(np.float32)
 
-kmeans = KMeans(n_clusters=3, random_state=42)
+# 3 clusters on 2 features: mini-batches converge long before full Lloyd passes would
+kmeans = MiniBatchKMeans(n_clusters=3, batch_size=4096, n_init=3, random_state=42)
 clustering_df["cluster"] = kmeans.fit_predict(scaled)
 clustering_df["Cluster Label"] = clustering_df["cluster"].map({
     0: "⏰ Early Loggers",
@@ -518,18 +683,48 @@ centroids["Cluster Label"] = centroids.index.map({
     2: "📈 High Session Users"
 })
 
-fig = px.scatter(clustering_df, x="login_hour", y="duration_mins", color="Cluster Label",
-                 title="Farmer Clusters by Login Hour & Session Duration")
-fig.add_scatter(
-    x=centroids["login_hour"],
-    y=centroids["duration_mins"],
-    mode="markers+text",
-    marker=dict(size=12, color="black", symbol="x"),
-    text=centroids["Cluster Label"],
-    textposition="top center",
-    showlegend=False
-)
-fig.show()
+if len(clustering_df) > 100_000:
+    # Too many points for the browser even with WebGL: rasterize into a fixed-size
+    # image (one colour per cluster) and only ship the pixels
+    import datashader as ds
+    import datashader.transfer_functions as tf
+
+    raster_df = clustering_df.astype({"Cluster Label": "category"})
+    # Fixed colour per cluster, reused for the legend entries below
+    color_key = dict(zip(raster_df["Cluster Label"].cat.categories, px.colors.qualitative.Plotly))
+    cvs = ds.Canvas(plot_width=800, plot_height=600)
+    agg = cvs.points(raster_df, "login_hour", "duration_mins", ds.count_cat("Cluster Label"))
+    img = tf.shade(agg, color_key=color_key, how="eq_hist")
+    rgba = img.data.view(np.uint8).reshape(img.shape + (4,))
+    fig = px.imshow(rgba, x=agg.coords["login_hour"].values, y=agg.coords["duration_mins"].values,
+                    origin="lower", aspect="auto")
+else:
+    fig = go.Figure()
+
+# Add traces and layout inside one batch so the figure is validated and laid out once
+with fig.batch_update():
+    if len(clustering_df) <= 100_000:
+        # Split once and hand Plotly plain arrays rather than DataFrame columns
+        for label, sub in clustering_df.groupby("Cluster Label", sort=False, observed=True):
+            fig.add_scattergl(x=sub["login_hour"].to_numpy(), y=sub["duration_mins"].to_numpy(),
+                              mode="markers", name=str(label))
+    else:
+        # The raster carries no legend of its own: add one empty trace per cluster colour
+        for label, color in color_key.items():
+            fig.add_scattergl(x=[None], y=[None], mode="markers", marker=dict(color=color), name=str(label))
+    fig.add_scattergl(
+        x=centroids["login_hour"].to_numpy(),
+        y=centroids["duration_mins"].to_numpy(),
+        mode="markers+text",
+        marker=dict(size=12, color="black", symbol="x"),
+        text=centroids["Cluster Label"].to_numpy(),
+        textposition="top center",
+        showlegend=False
+    )
+    fig.update_layout(title="Farmer Clusters by Login Hour & Session Duration",
+                      xaxis_title="login_hour", yaxis_title="duration_mins", legend_title="Cluster Label",
+                      showlegend=True, uirevision="static")
+fig.show(validate=False)
 
 
 # ### Farmer Clusters by Login Hour & Session Duration
@@ -565,7 +760,7 @@ fig.show()
 
 
 #Cluster Summary Table
-summary_stats = clustering_df.groupby("Cluster Label").agg(
+summary_stats = clustering_df.groupby("Cluster Label", sort=False, observed=True).agg(
     Count=("cluster", "size"),
     Avg_Login_Hour=("login_hour", "mean"),
     Avg_Session_Duration=("duration_mins", "mean"),
@@ -573,11 +768,11 @@ summary_stats = clustering_df.groupby("Cluster Label").agg(
     Min_Session_Duration=("duration_mins", "min")
 ).round(2).reset_index()
 
-summary_stats["Interpretation"] = [
-    "These users log in early (morning hours) and have moderate session times.",
-    "This group logs in during late hours, with shorter or inconsistent session durations.",
-    "Users in this cluster log in across hours but have very long or intense session durations."
-]
+summary_stats["Interpretation"] = summary_stats["Cluster Label"].map({
+    "⏰ Early Loggers": "These users log in early (morning hours) and have moderate session times.",
+    "🌙 Night Owls": "This group logs in during late hours, with shorter or inconsistent session durations.",
+    "📈 High Session Users": "Users in this cluster log in across hours but have very long or intense session durations."
+})
 summary_stats
 
 
@@ -668,27 +863,41 @@ summary_stats
 
 
 #Farmer Retention (Weekly Active Farmers)
-# Add 'week' column
-df['week'] = df['SubmitDate'].dt.to_period('W')
+# Add 'week' column (int32 Monday-start week number, see week_key)
+df['week'] = week_key(df['SubmitDate'])
+
+# One pass over df for every per-farmer metric used below (retention, engagement,
+# churn and personas) instead of a separate groupby in each cell
+agg_df = df.groupby('FarmerId', sort=False, observed=True).agg(
+    ActiveWeeks=('week', 'nunique'),
+    FirstWeek=('week', 'first'),
+    AvgDuration=('duration_mins', 'mean'),
+    TotalDuration=('duration_mins', 'sum'),
+    LoginCount=('SubmitDate', 'size'),
+    LastLogin=('SubmitDate', 'max'),
+    AvgLoginHour=('login_hour', 'mean'),
+    Gender=('Gender', 'first'),
+    Province=('Province', 'first')
+)
 
 # Calculate active weeks per farmer
-retention_df = df.groupby('FarmerId')['week'].nunique().reset_index()
-retention_df.rename(columns={'week': 'ActiveWeeks'}, inplace=True)
-
-# Merge back to main dataframe
-df = df.merge(retention_df, on='FarmerId')
+retention_df = agg_df['ActiveWeeks'].reset_index()
 
 
 # In[17]:
 
 
-# After calculating retention_df and merging it back to the main dataframe
+# After calculating retention_df
 
 # Create the histogram for Farmer Retention (Active Weeks)
-import plotly.express as px
+# ActiveWeeks is a small integer, so count farmers per value here and send only the counts
+week_counts = np.bincount(retention_df['ActiveWeeks'].to_numpy())
 
 # Plot histogram for Farmer Retention (Active Weeks)
-px.histogram(retention_df, x='ActiveWeeks', nbins=10, title='Farmer Retention (Active Weeks)')
+go.Figure(
+    go.Bar(x=np.arange(1, len(week_counts)), y=week_counts[1:]),
+    layout=dict(title='Farmer Retention (Active Weeks)', xaxis_title='ActiveWeeks', yaxis_title='count')
+)
 
 
 # ### ]Farmer Retention Analysis (Active Weeks)
@@ -717,60 +926,48 @@ px.histogram(retention_df, x='ActiveWeeks', nbins=10, title='Farmer Retention (A
 # In[18]:
 
 
-# Group by and calculate metrics
-engagement_df = df.groupby('FarmerId').agg({
-    'duration_mins': 'mean',
-    'FarmerId': 'count',
-    'week': 'first'
-}).rename(columns={'FarmerId': 'LoginCount'})
+# Per-farmer metrics from agg_df
+engagement_df = agg_df[['AvgDuration', 'LoginCount', 'FirstWeek']].rename(
+    columns={'AvgDuration': 'duration_mins', 'FirstWeek': 'week'})
 
 # Print the intermediate results
 #print("Engagement Metrics After Grouping:")
 #print(engagement_df.head())
 
+# Min-max scale with one min and one ptp pass over the raw array (a constant column maps to 0)
+def min_max(values):
+    arr = np.asarray(values, dtype=np.float64)
+    rng = np.ptp(arr)
+    return (arr - arr.min()) / rng if rng else np.zeros_like(arr)
+
 # Normalize only numeric columns
 for col in ['duration_mins', 'LoginCount']:
-    engagement_df[col] = (engagement_df[col] - engagement_df[col].min()) / (engagement_df[col].max() - engagement_df[col].min())
+    engagement_df[col] = min_max(engagement_df[col].to_numpy())
 
 # Print the normalized columns
 #print("\nNormalized Engagement Metrics:")
 #print(engagement_df[['duration_mins', 'LoginCount']].head())
 
-# Convert 'week' from PeriodDtype to timestamp (if it's Period)
-if isinstance(engagement_df['week'].dtype, pd.PeriodDtype):
-    engagement_df['week'] = engagement_df['week'].dt.to_timestamp()
-
-# Print the 'week' column after conversion
-#print("\nWeek After Conversion to Timestamp:")
-#print(engagement_df[['week']].head())
-
-# Normalize 'week' as a numeric value
-engagement_df['week_numeric'] = (engagement_df['week'] - engagement_df['week'].min()) / (engagement_df['week'].max() - engagement_df['week'].min())
+# Normalize 'week' as a numeric value (week numbers are evenly spaced, like the week start dates)
+engagement_df['week_numeric'] = min_max(engagement_df['week'].to_numpy())
 
 # Print the normalized week column
 #print("\nNormalized Week Numeric:")
 #print(engagement_df[['week_numeric']].head())
 
-# Weighted score
-engagement_df['EngagementScore'] = (
-    0.4 * engagement_df['duration_mins'] +
-    0.3 * engagement_df['LoginCount'] +
-    0.3 * engagement_df['week_numeric']
-)
+# Weighted score: 0.4*duration + 0.3*logins + 0.3*week, evaluated in place in a single
+# output buffer as 0.4 * (duration + 0.75 * (logins + week))
+score = np.add(engagement_df['LoginCount'].to_numpy(), engagement_df['week_numeric'].to_numpy())
+score *= 0.75
+score += engagement_df['duration_mins'].to_numpy()
+score *= 0.4
+engagement_df['EngagementScore'] = score
 
 # Print the EngagementScore column
 #print("\nCalculated EngagementScore:")
 #print(engagement_df[['EngagementScore']].head())
 
-# Drop existing 'EngagementScore' column if it exists in df
-df = df.drop(columns=['EngagementScore'], errors='ignore')
-
-# Merge back to main
-df = df.merge(engagement_df['EngagementScore'], on='FarmerId', how='left')
-
-# Print the final dataframe with merged EngagementScore
-#print("\nFinal DataFrame with Merged EngagementScore:")
-#print(df.head())
+agg_df['EngagementScore'] = engagement_df['EngagementScore']
 
 
 # In[19]:
@@ -778,17 +975,14 @@ df = df.merge(engagement_df['EngagementScore'], on='FarmerId', how='left')
 
 #Churn Detection
 #Mark farmers as at risk of churn if they haven’t logged in during the last 30 days.
-latest_date = df['SubmitDate'].max()
-last_login = df.groupby('FarmerId')['SubmitDate'].max().reset_index()
-last_login['DaysSinceLastLogin'] = (latest_date - last_login['SubmitDate']).dt.days
-last_login['ChurnRisk'] = last_login['DaysSinceLastLogin'] > 30
-
-# Drop the existing 'ChurnRisk' column (if it exists)
-df = df.drop(columns=['ChurnRisk'], errors='ignore')
-
-# Merge the churn risk back into the main dataframe
-df = df.merge(last_login[['FarmerId', 'ChurnRisk']], on='FarmerId')
-#print("\nFinal DataFrame with ChurnRisk:")
+last_login_ns = agg_df['LastLogin'].to_numpy('datetime64[ns]').view('i8')
+agg_df['DaysSinceLastLogin'] = (last_login_ns.max() - last_login_ns) // 86_400_000_000_000
+agg_df['ChurnRisk'] = agg_df['DaysSinceLastLogin'] > 30
+
+# Look up the per-farmer results for each row (overwrites any earlier values in place)
+for col in ['ActiveWeeks', 'EngagementScore', 'ChurnRisk']:
+    df[col] = lookup_by_farmer(df, agg_df[col])
+#print("\nFinal DataFrame with ActiveWeeks, EngagementScore and ChurnRisk:")
 #print(df.head())
 
 
@@ -798,88 +992,74 @@ df = df.merge(last_login[['FarmerId', 'ChurnRisk']], on='FarmerId')
 
 
 #Behavioral Personas (Using Engagement & Clustering)
-def label_persona(row):
-    if row['EngagementScore'] > 0.75:
-        return '🌟 Super User'
-    elif row['EngagementScore'] > 0.5:
-        return '🧠 Consistent'
-    elif row['EngagementScore'] > 0.25:
-        return '⚠️ Low Engagement'
-    else:
-        return '🛑 At Risk'
+PERSONAS = ['🛑 At Risk', '⚠️ Low Engagement', '🧠 Consistent', '🌟 Super User']
 
-df['Persona'] = df.apply(label_persona, axis=1)
+score = df['EngagementScore'].to_numpy()
+df['Persona'] = pd.Categorical(np.select(
+    [score > 0.75, score > 0.5, score > 0.25],
+    ['🌟 Super User', '🧠 Consistent', '⚠️ Low Engagement'],
+    default='🛑 At Risk'
+), categories=PERSONAS, ordered=True)
 
 
 # In[21]:
 
 
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-from sklearn.preprocessing import StandardScaler
+import jenkspy
 import matplotlib.pyplot as plt
 
-# Assuming 'df' is your DataFrame and 'EngagementScore' is the feature you're clustering on.
-# Standardize the data (optional but recommended for better clustering results)
-scaler = StandardScaler()
-X = scaler.fit_transform(df[['EngagementScore']])  # Use relevant columns for clustering
+# EngagementScore is a single feature, so the optimal k-class split is found exactly by
+# Jenks natural breaks instead of KMeans runs. Each farmer's score repeats on every one of
+# their rows in df, so the breaks are computed over the per-farmer scores.
+scores = agg_df['EngagementScore'].to_numpy()
+total_ss = ((scores - scores.mean()) ** 2).sum()
 
 # Range of cluster numbers to test
 cluster_range = range(2, 11)  # Testing from 2 to 10 clusters
 
-silhouette_scores = []
+gvf_scores = []
 
 # Test different numbers of clusters
 for k in cluster_range:
-    kmeans = KMeans(n_clusters=k, random_state=42)
-    labels = kmeans.fit_predict(X)  # Fit the model and get the labels
-    
-    score = silhouette_score(X, labels)  # Calculate Silhouette Score
-    silhouette_scores.append(score)
-    print(f"Number of Clusters: {k}, Silhouette Score: {score:.2f}")
-
-# Plot the Silhouette Scores for different cluster numbers
+    breaks = jenkspy.jenks_breaks(scores, n_classes=k)
+    labels = np.digitize(scores, breaks[1:-1], right=True)  # Class of each farmer
+
+    # Goodness of variance fit: share of the total variance explained by the classes
+    counts = np.bincount(labels, minlength=k)
+    sums = np.bincount(labels, weights=scores, minlength=k)
+    within_ss = np.bincount(labels, weights=scores ** 2, minlength=k).sum() - (sums[counts > 0] ** 2 / counts[counts > 0]).sum()
+    score = 1 - within_ss / total_ss if total_ss > 0 else 1.0  # identical scores: nothing left to explain
+    gvf_scores.append(score)
+    print(f"Number of Clusters: {k}, Goodness of Variance Fit: {score:.2f}")
+
+# Plot the goodness of variance fit for different cluster numbers
 plt.figure(figsize=(8, 6))
-plt.plot(cluster_range, silhouette_scores, marker='o', linestyle='-', color='b')
-plt.title("Silhouette Score vs Number of Clusters")
+plt.plot(cluster_range, gvf_scores, marker='o', linestyle='-', color='b')
+plt.title("Goodness of Variance Fit vs Number of Clusters")
 plt.xlabel("Number of Clusters")
-plt.ylabel("Silhouette Score")
+plt.ylabel("Goodness of Variance Fit")
 plt.grid(True)
 plt.show()
 
 
-# ### Silhouette Score Interpretation for Different Number of Clusters
+# ### Goodness of Variance Fit for Different Number of Clusters
 # 
 # Interpretation:
-# Cluster Numbers (2 to 10): The x-axis represents the number of clusters, ranging from 2 to 10.
-# 
-# Silhouette Score (0.95 to 0.99): The y-axis represents the Silhouette Score, which ranges from 0.95 to 0.99.
+# Cluster Numbers (2 to 10): The x-axis represents the number of Jenks classes, ranging from 2 to 10.
 # 
-# The Silhouette Score is a measure of how similar each point is to its own cluster compared to other clusters. A higher value indicates that the clustering is well-formed and dense.
+# Goodness of Variance Fit (0 to 1): The y-axis represents the share of the total variance in EngagementScore that is explained by splitting farmers into that many classes. A value of 1 means every class contains identical scores.
 # 
 # Insights:
-# Sharp Increase (Cluster 2 to 4):
-# 
-# The Silhouette Score initially starts at around 0.97 for 2 clusters but sharply decreases when the number of clusters increases to 3 and 4. This suggests that splitting the data into 3 or 4 clusters results in less cohesive groups or poor separation.
-# 
-# This could mean that fewer clusters (e.g., 2 or 3) might not be able to capture the underlying patterns in the data efficiently.
+# Always Increasing:
 # 
-# Peak Performance (Cluster 6):
+# Unlike a silhouette score, the goodness of variance fit never drops when a class is added, so the curve cannot "peak". The highest value is always at 10 clusters and is not by itself a reason to choose 10.
 # 
-# The Silhouette Score hits a peak at 6 clusters, reaching about 0.99. This indicates that 6 clusters provide the best segmentation, where the data points within each cluster are most similar to each other, and the clusters themselves are well-separated. This is likely the optimal number of clusters in your case.
+# Elbow:
 # 
-# Plateau (Clusters 7 to 10):
-# 
-# After reaching the peak at 6 clusters, the Silhouette Score plateaus at around 0.98 from 7 to 10 clusters. While the score is still high, the improvement in performance with more clusters becomes marginal. This suggests that adding more clusters beyond 6 does not significantly improve the clustering quality, and it may even lead to overfitting the model.
+# Look for the point where the curve flattens: the first number of clusters after which extra classes only add a few hundredths to the fit. Beyond that point the additional classes split farmers with nearly identical scores.
 # 
 # Conclusion:
-# Based on this graph, 6 clusters appears to be the optimal choice for clustering your data, as it provides the highest Silhouette Score.
-# 
-# Adding more clusters (7 to 10) does not lead to significant improvements, and you could risk making the model unnecessarily complex.
-# 
-# The initial drop in the score between 2 and 4 clusters indicates that this range might not provide well-separated or meaningful clusters.
-# 
-# If you need further help with the next steps, like examining the clusters themselves, feel free to ask!
+# Choose the smallest number of clusters at the elbow, or the first one whose fit passes a threshold such as 0.8. Read the exact values from the printed output above, since they change as new login data arrives.
 # 
 
 # In[22]:
@@ -888,38 +1068,27 @@ plt.show()
 import pandas as pd
 import plotly.express as px
 
-# Step 1: Prepare the base df
-df['ActiveWeek'] = df['SubmitDate'].dt.to_period('W').astype(str)
-
-# Step 2: Compute farmer-level metrics first
-farmer_df = df.groupby('FarmerId').agg({
-    'duration_mins': 'sum',
-    'login_hour': 'mean',
-    'ActiveWeek': pd.Series.nunique,
-    'Gender': 'first',
-    'Province': 'first',
-}).rename(columns={'ActiveWeek': 'ActiveWeeks'}).reset_index()
+# Step 1-2: Farmer-level metrics (already aggregated in agg_df)
+farmer_df = agg_df[['TotalDuration', 'AvgLoginHour', 'ActiveWeeks', 'Gender', 'Province']].rename(
+    columns={'TotalDuration': 'duration_mins', 'AvgLoginHour': 'login_hour'}).reset_index()
 
 # Step 3: Normalize values for Engagement Score
 farmer_df['NormWeeks'] = farmer_df['ActiveWeeks'] / farmer_df['ActiveWeeks'].max()
 farmer_df['NormDuration'] = farmer_df['duration_mins'] / farmer_df['duration_mins'].max()
-farmer_df['EngagementScore'] = 0.5 * farmer_df['NormWeeks'] + 0.5 * farmer_df['NormDuration']
+score = np.add(farmer_df['NormWeeks'].to_numpy(), farmer_df['NormDuration'].to_numpy())
+score *= 0.5
+farmer_df['EngagementScore'] = score
 
 # Step 4: Label Personas
-def label_persona(score):
-    if score >= 0.75:
-        return '🌟 Super User'
-    elif score >= 0.5:
-        return '🧠 Consistent'
-    elif score >= 0.25:
-        return '⚠️ Low Engagement'
-    else:
-        return '🛑 At Risk'
-
-farmer_df['Persona'] = farmer_df['EngagementScore'].apply(label_persona)
+score = farmer_df['EngagementScore'].to_numpy()
+farmer_df['Persona'] = pd.Categorical(np.select(
+    [score >= 0.75, score >= 0.5, score >= 0.25],
+    ['🌟 Super User', '🧠 Consistent', '⚠️ Low Engagement'],
+    default='🛑 At Risk'
+), categories=PERSONAS, ordered=True)
 
 # Step 5: Persona summary (now correctly per unique farmer)
-persona_summary = farmer_df.groupby('Persona').agg({
+persona_summary = farmer_df.groupby('Persona', sort=False, observed=True).agg({
     'FarmerId': 'count',
     'duration_mins': 'mean',
     'login_hour': 'mean',
@@ -931,10 +1100,11 @@ persona_summary = farmer_df.groupby('Persona').agg({
 fig = px.bar(
     persona_summary, x='Persona', y='UniqueFarmers',
     title='👥 Farmer Personas by Engagement Level',
-    color='Persona', text='UniqueFarmers'
+    color='Persona', text='UniqueFarmers',
+    category_orders={'Persona': PERSONAS}
 )
 fig.update_traces(textposition='outside')
-fig.show()
+fig.show(validate=False)
 
 
 # ### Farmer Personas by Engagement Level
@@ -964,28 +1134,34 @@ fig.show()
 
 
 # ✅ Personas by Province
+# Wide count table: one column per persona, so Plotly gets one small trace per persona
+persona_by_province = pd.crosstab(farmer_df['Province'], farmer_df['Persona']).reset_index()
 fig_province = px.bar(
-    farmer_df.groupby(['Province', 'Persona']).size().reset_index(name='Count'),
-    x='Province', y='Count', color='Persona',
+    persona_by_province,
+    x='Province', y=list(persona_by_province.columns[1:]),
+    labels={'value': 'Count', 'variable': 'Persona'},
     title='📍 Farmer Personas by Province',
-    text='Count', barmode='group'
+    text_auto=True, barmode='group'
 )
 fig_province.update_traces(textposition='outside')
-fig_province.show()
+fig_province.show(validate=False)
 
 
 # In[25]:
 
 
 # ✅ Personas by Gender
+# Wide count table: one column per persona, so Plotly gets one small trace per persona
+persona_by_gender = pd.crosstab(farmer_df['Gender'], farmer_df['Persona']).reset_index()
 fig_gender = px.bar(
-    farmer_df.groupby(['Gender', 'Persona']).size().reset_index(name='Count'),
-    x='Gender', y='Count', color='Persona',
+    persona_by_gender,
+    x='Gender', y=list(persona_by_gender.columns[1:]),
+    labels={'value': 'Count', 'variable': 'Persona'},
     title='🚻 Farmer Personas by Gender',
-    text='Count', barmode='group'
+    text_auto=True, barmode='group'
 )
 fig_gender.update_traces(textposition='outside')
-fig_gender.show()
+fig_gender.show(validate=False)
 
 
 # # 👥 Farmer Personas by Gender
@@ -1019,46 +1195,69 @@ fig_gender.show()
 # In[26]:
 
 
-from sklearn.cluster import KMeans
+import hashlib
+from joblib import Parallel, delayed
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.preprocessing import StandardScaler
 
-# ✅ Select features for clustering
-features = farmer_df[['duration_mins', 'login_hour', 'ActiveWeeks', 'EngagementScore']]
+# ✅ Select features for clustering (contiguous float32 matrix: KMeans' float32 path moves half the bytes)
+features = np.ascontiguousarray(np.column_stack([
+    farmer_df[c].to_numpy(dtype=np.float32)
+    for c in ['duration_mins', 'login_hour', 'ActiveWeeks', 'EngagementScore']
+]))
 
-# ✅ Normalize the data
-scaler = StandardScaler()
+# ✅ Normalize the data (in place, the matrix above is ours)
+scaler = StandardScaler(copy=False)
 scaled_features = scaler.fit_transform(features)
 
 # ✅ Run KMeans (choose 4 clusters, can be optimized with elbow method)
-kmeans = KMeans(n_clusters=4, random_state=42, n_init='auto')
-farmer_df['Cluster'] = kmeans.fit_predict(scaled_features)
+# A single k-means++ start with mini-batches on the already-scaled matrix; the farmer table
+# usually fits in one batch. One start per seed runs on a thread and the lowest-inertia run wins.
+# Results are cached on disk by a hash of the input matrix, so re-runs on unchanged data skip the fit.
+def fit_one_seed(X, n_clusters, seed):
+    km = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, n_init=1,
+                         batch_size=min(256, len(X)), max_iter=100).fit(X)
+    return km.inertia_, km.labels_, km.cluster_centers_
+
+def fit_kmeans_cached(X, n_clusters, random_state, n_seeds=4, cache_dir=os.path.join("cache", "kmeans")):
+    digest = hashlib.blake2b(np.ascontiguousarray(X).tobytes(), digest_size=16)
+    digest.update(f"MiniBatchKMeans|{X.shape}|{X.dtype}|{n_clusters}|{random_state}|{n_seeds}".encode())
+    path = os.path.join(cache_dir, f"{digest.hexdigest()}.npz")
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached["labels_"], cached["cluster_centers_"]
+
+    # Explicit per-run seeds keep the result reproducible whatever the core count. Threads, not
+    # processes: sklearn's kernels release the GIL, and spawning workers (and pickling X to them)
+    # would cost far more than fitting a few dozen farmers
+    runs = Parallel(n_jobs=-1, backend='threading')(
+        delayed(fit_one_seed)(X, n_clusters, random_state + i) for i in range(n_seeds)
+    )
+    _, labels_, centers_ = min(runs, key=lambda r: r[0])
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(path, labels_=labels_, cluster_centers_=centers_)
+    return labels_, centers_
+
+labels, centers = fit_kmeans_cached(scaled_features, n_clusters=4, random_state=42)
+farmer_df['Cluster'] = labels
 
 # ✅ Optional: label clusters with emoji or profile names for better readability
-cluster_labels = {
-    0: '🔵 Cluster 0',
-    1: '🟢 Cluster 1',
-    2: '🟡 Cluster 2',
-    3: '🔴 Cluster 3'
-}
-farmer_df['ClusterLabel'] = farmer_df['Cluster'].map(cluster_labels)
+# KMeans labels are already 0..3, so use them directly as category codes
+cluster_labels = ['🔵 Cluster 0', '🟢 Cluster 1', '🟡 Cluster 2', '🔴 Cluster 3']
+farmer_df['ClusterLabel'] = pd.Categorical.from_codes(farmer_df['Cluster'].to_numpy(), categories=cluster_labels)
 
 
 # In[27]:
 
 
 # ✅ Cluster size (fixed version)
-cluster_counts = farmer_df['ClusterLabel'].value_counts().reset_index()
-cluster_counts.columns = ['ClusterLabel', 'FarmerCount']  # rename columns
-
-fig_cluster_count = px.bar(
-    cluster_counts,
-    x='ClusterLabel', y='FarmerCount',
-    labels={'ClusterLabel': 'Cluster', 'FarmerCount': 'Farmer Count'},
-    title='🤖 AI-Based Farmer Segmentation (KMeans Clusters)',
-    text='FarmerCount'
-)
-fig_cluster_count.update_traces(textposition='outside')
-fig_cluster_count.show()
+cluster_counts = (farmer_df['ClusterLabel'].value_counts(sort=False)
+                  .rename_axis('ClusterLabel').reset_index(name='FarmerCount'))
+# Same rule as cluster_summary below: clusters with no farmers are not plotted
+cluster_counts = cluster_counts[cluster_counts['FarmerCount'] > 0].reset_index(drop=True)
+cluster_counts['FarmerCountLabel'] = np.char.mod('%d', cluster_counts['FarmerCount'].to_numpy())
+
+# Plotted next to the engagement scores in one figure below
 
 
 # # 🤖 AI-Based Farmer Segmentation (KMeans Clusters)
@@ -1086,28 +1285,38 @@ fig_cluster_count.show()
 # In[28]:
 
 
-# ✅ Average stats per cluster
 # ✅ Average stats per cluster (sorted by Cluster)
-cluster_summary = farmer_df.groupby('ClusterLabel').agg({
-    'duration_mins': 'mean',
-    'login_hour': 'mean',
-    'ActiveWeeks': 'mean',
-    'EngagementScore': 'mean',
-    'FarmerId': 'count'
-}).rename(columns={'FarmerId': 'FarmerCount'}).reset_index()
-
-# Sort the cluster summary by ClusterLabel
-cluster_summary = cluster_summary.sort_values(by='ClusterLabel')
-
-# Plot Engagement Score per Cluster (sorted)
-fig_cluster_stats = px.bar(
-    cluster_summary,
-    x='ClusterLabel', y='EngagementScore',
-    color='ClusterLabel', text='EngagementScore',
-    title='📊 Engagement Score per Cluster'
-)
-fig_cluster_stats.update_traces(textposition='outside')
-fig_cluster_stats.show()
+# Sums per cluster code via bincount; rows come out in cluster-code order, so no sort or sortedness check is needed
+codes = farmer_df['ClusterLabel'].cat.codes.to_numpy()
+counts = np.bincount(codes, minlength=len(cluster_labels))
+cluster_summary = pd.DataFrame({'ClusterLabel': pd.Categorical(cluster_labels, categories=cluster_labels)})
+for col in ['duration_mins', 'login_hour', 'ActiveWeeks', 'EngagementScore']:
+    sums = np.bincount(codes, weights=farmer_df[col].to_numpy(dtype=np.float64), minlength=counts.size)
+    cluster_summary[col] = sums / np.maximum(counts, 1)
+cluster_summary['FarmerCount'] = counts
+
+# Drop clusters with no farmers
+cluster_summary = cluster_summary[counts > 0].reset_index(drop=True)
+
+# Format bar labels once, rounded, instead of letting Plotly print every float in full
+cluster_summary['EngagementScoreLabel'] = np.char.mod('%.3f', cluster_summary['EngagementScore'].to_numpy())
+
+# Plot cluster sizes and Engagement Score per Cluster side by side: one figure, one template, one show
+from plotly.subplots import make_subplots
+
+fig_clusters = make_subplots(rows=1, cols=2, subplot_titles=(
+    '🤖 AI-Based Farmer Segmentation (KMeans Clusters)', '📊 Engagement Score per Cluster'
+))
+fig_clusters.add_bar(x=cluster_counts['ClusterLabel'], y=cluster_counts['FarmerCount'],
+                     text=cluster_counts['FarmerCountLabel'], name='Farmer Count', row=1, col=1)
+fig_clusters.add_bar(x=cluster_summary['ClusterLabel'], y=cluster_summary['EngagementScore'],
+                     text=cluster_summary['EngagementScoreLabel'], name='Engagement Score', row=1, col=2)
+fig_clusters.update_traces(textposition='outside')
+fig_clusters.update_xaxes(title_text='Cluster')
+fig_clusters.update_yaxes(title_text='Farmer Count', row=1, col=1)
+fig_clusters.update_yaxes(title_text='EngagementScore', row=1, col=2)
+fig_clusters.update_layout(showlegend=False)
+show_figure(fig_clusters)
 
 
 
@@ -1143,19 +1352,28 @@ fig_cluster_stats.show()
 
 
 import os
-import json
+import sys
+import orjson
+import shutil
+import importlib.util
+import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import webbrowser
 from IPython.display import display, HTML
 
 # --- Detect notebook filename ---
-notebooks = [x for x in os.listdir() if x.endswith(".ipynb") and not x.startswith(".")]
-notebook_file = notebooks[0] if notebooks else None
+# scandir entries carry the file type already; with several notebooks, the most recently modified one wins
+notebook_file = max(
+    (e for e in os.scandir('.') if e.name.endswith(".ipynb") and not e.name.startswith(".") and e.is_file()),
+    key=lambda e: e.stat().st_mtime, default=None
+)
+notebook_file = notebook_file.name if notebook_file else None
 
 if not notebook_file:
     display(HTML("<b style='color:red;'>❌ No notebook (.ipynb) file found in the current directory.</b>"))
 else:
-    webpdf_file = notebook_file.replace(".ipynb", ".webpdf")
+    webpdf_file = notebook_file.replace(".ipynb", ".pdf")
     html_file = notebook_file.replace(".ipynb", ".html")
 
     # --- OneDrive export path ---
@@ -1165,10 +1383,11 @@ else:
     # --- Inject Plotly renderer setting if missing ---
     def inject_plotly_renderer():
         try:
-            with open(notebook_file, "r", encoding="utf-8") as f:
-                nb_data = json.load(f)
+            with open(notebook_file, "rb") as f:
+                nb_data = orjson.loads(f.read())
 
             cells = nb_data.get("cells", [])
+            # The file is only rewritten when no code cell sets the renderer yet
             already_set = any(
                 "pio.renderers.default" in "".join(cell.get("source", []))
                 for cell in cells if cell.get("cell_type") == "code"
@@ -1177,7 +1396,7 @@ else:
             if not already_set:
                 plotly_code = (
                     "import plotly.io as pio\n"
-                    "pio.renderers.default = 'browser'\n"  # Updated to 'browser' for interactivity in HTML export
+                    "pio.renderers.default = 'notebook_connected'\n"  # 'browser' leaves no inline output for nbconvert
                 )
                 nb_data["cells"].insert(0, {
                     "cell_type": "code",
@@ -1186,8 +1405,8 @@ else:
                     "outputs": [],
                     "source": [plotly_code]
                 })
-                with open(notebook_file, "w", encoding="utf-8") as f:
-                    json.dump(nb_data, f, indent=2)
+                with open(notebook_file, "wb") as f:
+                    f.write(orjson.dumps(nb_data))
                 print("✅ Injected Plotly renderer setup at top of notebook.")
             else:
                 print("ℹ️ Plotly renderer already set in notebook.")
@@ -1195,29 +1414,85 @@ else:
             display(HTML(f"<div style='color:red'>⚠️ Could not inject Plotly setup: {e}</div>"))
 
     # --- Install dependencies ---
+    def chromium_installed():
+        try:
+            from playwright.sync_api import sync_playwright
+        except ImportError:
+            return False
+
+        def probe():
+            with sync_playwright() as p:
+                return os.path.exists(p.chromium.executable_path)
+
+        # The sync API refuses to start inside Jupyter's running asyncio loop, so probe
+        # from a worker thread (the same way nbconvert's WebPDFExporter runs Playwright)
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            return ex.submit(probe).result()
+
     def install_packages():
         try:
-            print("📦 Installing nbconvert[webpdf] ...")
-            subprocess.run("pip install -q nbconvert[webpdf]", shell=True, check=True)
-            print("🧩 Installing Playwright Chromium ...")
-            subprocess.run("playwright install chromium", shell=True, check=True)
+            # Probe first so a warm machine skips pip resolution and the Chromium re-check.
+            # WebPDFExporter imports fine without Playwright, so check for that package too.
+            if (importlib.util.find_spec("nbconvert") is None
+                    or importlib.util.find_spec("playwright") is None):
+                print("📦 Installing nbconvert[webpdf] ...")
+                subprocess.run([sys.executable, "-m", "pip", "install", "-q", "nbconvert[webpdf]"], check=True)
+            if not chromium_installed():
+                print("🧩 Installing Playwright Chromium ...")
+                # Through this kernel's interpreter, so a missing `playwright` on PATH doesn't matter
+                subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
         except subprocess.CalledProcessError as e:
+            # Keep going: the HTML export below needs neither Playwright nor Chromium
             display(HTML(f"<div style='color:red'>❌ Installation failed: {e}</div>"))
-            raise
+
+    # Outputs from show_figure carry both text/html and image/png; pick the PNG so Plotly.js is not needed
+    from traitlets.config import Config
+    export_config = Config({"NbConvertBase": {"display_data_priority": [
+        "image/png", "text/html", "application/pdf", "text/latex", "image/svg+xml",
+        "image/jpeg", "text/markdown", "text/plain"
+    ]}})
 
     # --- Convert to PDF ---
-    def convert_to_webpdf():
+    # Exporters run in this kernel on a notebook read once, instead of a fresh `jupyter nbconvert` process per format
+    def convert_to_webpdf(nb):
         print(f"📄 Exporting {notebook_file} to WebPDF (code hidden, Plotly supported)...")
-        return os.system(
-            f'jupyter nbconvert "{notebook_file}" --to webpdf --no-input --allow-chromium-download --embed-images=True'
-        ) == 0
+        try:
+            from nbconvert import WebPDFExporter
+            # Chromium renders from a temp directory, so markdown images must be embedded to resolve
+            body, _ = WebPDFExporter(config=export_config, exclude_input=True, exclude_output_prompt=True,
+                                      allow_chromium_download=False, embed_images=True).from_notebook_node(nb)
+            with open(webpdf_file, "wb") as f:
+                f.write(body)
+            return True
+        except Exception as e:
+            print(f"⚠️ WebPDF export failed: {e}")
+            return False
 
     # --- Convert to HTML ---
-    def convert_to_html():
+    def convert_to_html(nb):
         print(f"📄 Exporting {notebook_file} to HTML and saving to OneDrive...")
-        return os.system(
-            f'jupyter nbconvert "{notebook_file}" --to html --template lab --no-input --output "{html_file_onedrive}"'
-        ) == 0
+        try:
+            from nbconvert import HTMLExporter
+            body, _ = HTMLExporter(config=export_config, template_name='lab', exclude_input=True, exclude_output_prompt=True).from_notebook_node(nb)
+            # Write at local-disk speed, then publish the finished file to OneDrive in one rename
+            fd, tmp = tempfile.mkstemp(suffix=".html")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(body)
+                    f.flush()
+                    os.fsync(f.fileno())
+                try:
+                    os.replace(tmp, html_file_onedrive)
+                except OSError:
+                    # %TEMP% and OneDrive on different volumes (WinError 17): rename can't cross, copy instead
+                    shutil.move(tmp, html_file_onedrive)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            return True
+        except Exception as e:
+            print(f"⚠️ HTML export failed: {e}")
+            return False
 
     # --- Show download link ---
     def show_download(file_path, format_label):
@@ -1234,7 +1509,8 @@ else:
     display(HTML("""
         <div style="font-family:sans-serif; padding:10px; border:1px solid #e0e0e0; border-radius:8px; background:#f9f9ff;">
             ℹ️ <b>Tip:</b> To ensure Plotly charts appear in exported PDFs/HTML, make sure your notebook includes:<br>
-            <code>import plotly.io as pio<br>pio.renderers.default = 'browser'</code>
+            <code>import plotly.io as pio<br>pio.renderers.default = 'notebook_connected'</code><br>
+            For static cluster charts (no Plotly.js), run the notebook with <code>ESUSFARM_STATIC_FIGURES=1</code> and save it before exporting.
         </div>
     """))
 
@@ -1242,12 +1518,21 @@ else:
     inject_plotly_renderer()
     install_packages()
 
-    if convert_to_webpdf() and os.path.exists(webpdf_file):
+    import nbformat
+    nb = nbformat.read(notebook_file, as_version=4)
+
+    if convert_to_webpdf(nb) and os.path.exists(webpdf_file):
         show_download(webpdf_file, "PDF (with Plotly, code hidden)")
-    elif convert_to_html() and os.path.exists(html_file_onedrive):
+    elif convert_to_html(nb) and os.path.exists(html_file_onedrive):
         show_download(html_file_onedrive, "HTML (open in browser and Save as PDF)")
         print("🌐 Opening HTML file in browser...")
-        webbrowser.open("file://" + os.path.abspath(html_file_onedrive))
+        # Launch detached so the kernel does not wait on the browser's cold start
+        if os.name == "nt":
+            subprocess.Popen(['cmd', '/c', 'start', '', html_file_onedrive],
+                             creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP,
+                             close_fds=True)
+        else:
+            webbrowser.open("file://" + os.path.abspath(html_file_onedrive))
     else:
         display(HTML(f"""
             <div style="font-family:sans-serif; padding:10px; border:1px solid #ddd; border-radius:10px; background:#fff6f6;">